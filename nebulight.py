@@ -18,9 +18,14 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import atexit
+import concurrent.futures
 import datetime
+import json
+import multiprocessing
 import os
 import random
+import select
 import shlex
 import socket
 import sqlite3 as sql
@@ -30,6 +35,16 @@ import time
 
 import argcomplete
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+try:
+    raw_input
+except NameError:
+    raw_input = input
+
 # Constants.
 QUEUED = 'queued'
 PROCESSING = 'processing'
@@ -39,53 +54,182 @@ HOLD = 'hold'
 ALL = [QUEUED, PROCESSING, DONE, FAILED, HOLD]
 IDLE_CHECK_INTERVAL_MIN = 0.1
 
+# SQL statements. Kept constant (the change time is a parameter) so sqlite3's statement cache can reuse them.
+UPDATE_STATUS = "UPDATE jobs SET status=?, time=? WHERE job_id=?"
+UPDATE_HOST = "UPDATE jobs SET host=?, time=? WHERE job_id=?"
+RESET_STATUS = "UPDATE jobs SET status=?, tries=0, time=? WHERE status=?"
+FAIL_EXHAUSTED_JOBS = "UPDATE jobs SET status=?, time=? WHERE status=? AND tries>=?"
+CLAIM_NEXT_JOB = ("UPDATE jobs SET status=?, tries=tries+1, time=? "
+                  "WHERE job_id=(SELECT job_id FROM jobs WHERE status=? ORDER BY job_id LIMIT 1) "
+                  "RETURNING job_id, cmd, tries, argv")
+
+# Column layout of the job table, the widths of the command and host columns depend on the content.
+TABLE_TEMPLATE = "{:<5}{:<{len_cmd}}{:<13}{:<7}{:<{len_host}}{:<11}"
+
+# Columns shown in job tables.
+TABLE_COLUMNS = "job_id, cmd, status, tries, host, time"
+
+# Schema of the job table. argv holds the JSON encoded, pre-split command, it is NULL only for jobs added by older
+# versions. {table} is 'jobs', or a temporary name while migrating an old database.
+JOBS_SCHEMA = ("CREATE TABLE IF NOT EXISTS {{table}} (job_id INTEGER PRIMARY KEY, cmd TEXT NOT NULL, "
+               "status TEXT NOT NULL DEFAULT '{}' CHECK (status IN ({})), tries INTEGER NOT NULL DEFAULT 0, "
+               "host TEXT, time TEXT, argv TEXT);".format(QUEUED, ", ".join("'{}'".format(s) for s in ALL)))
+
+# The host name doesn't change while we're running.
+_HOST = socket.gethostname()
+
+# One long-lived connection per database file, see _get_or_create_db.
+_CONN_CACHE = {}
+
 
 def _time_str():
     return datetime.datetime.now().strftime("%d.%m %H:%M")
 
 
-def _add_single_job(cursor, cmd, status):
-    cursor.execute("insert into jobs(cmd, status, tries, host, time) values (?, ?, ?, ?, ?)",
-                   (cmd, status, 0, '', _time_str()))
+def _add_single_job(cursor, cmd, argv, status):
+    _add_jobs(cursor, [(cmd, argv)], status)
+
+
+def _add_jobs(cursor, jobs, status):
+    time_str = _time_str()
+    cursor.executemany("insert into jobs(cmd, status, tries, host, time, argv) values (?, ?, ?, ?, ?, ?)",
+                       [(cmd, status, 0, '', time_str, argv) for (cmd, argv) in jobs])
+
+
+def _split_cmd(cmd):
+    argv = shlex.split(cmd)
+    if not argv:
+        raise ValueError("empty command")
+    return argv
 
 
-def _get_or_create_db(db_name):
-    conn = sql.connect(db_name)
+def _parse_jobs(cmds):
+    """
+    Returns (cmd, argv) pairs for all commands that can be run, with argv JSON encoded. Prints a message for, and
+    skips, every command that is empty or can't be parsed.
+    """
+    jobs = []
+    for cmd in cmds:
+        try:
+            jobs.append((cmd, json.dumps(_split_cmd(cmd))))
+        except ValueError as e:
+            print("Skipping invalid command {!r}: {}.".format(cmd, e))
+    return jobs
+
+
+def _get_or_create_db(db_name, wal=False):
+    if db_name in _CONN_CACHE:
+        conn = _CONN_CACHE[db_name]
+        return conn, conn.cursor()
+
+    # Autocommit: reads take no transaction, writers open one explicitly with _begin.
+    conn = sql.connect(db_name, isolation_level=None, cached_statements=256)
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY, cmd, status, tries, host, time);''')
+    # WAL means fewer fsyncs per commit and readers that don't block the worker, but it needs all users of the
+    # database on one machine. It is stored in the database file, so it is only switched on when asked for.
+    if wal:
+        c.execute('PRAGMA journal_mode=WAL;')
+    c.execute('PRAGMA synchronous=NORMAL;')
+    c.execute('PRAGMA busy_timeout=5000;')
+    c.execute('PRAGMA cache_size=-10000;')
+    c.execute(JOBS_SCHEMA.format(table='jobs'))
+    _migrate_schema(c)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);')
+
+    _CONN_CACHE[db_name] = conn
+    atexit.register(conn.close)
     return conn, c
 
 
-def _commit_and_close(conn, cursor):
+def _table_columns(c):
+    c.execute("PRAGMA table_info(jobs)")
+    return dict((col[1], col[2]) for col in c.fetchall())
+
+
+def _migrate_schema(c):
+    """
+    Brings databases created by older versions up to the current schema. Untyped tables, possibly without host
+    and time columns, are copied into a table with the current schema. Tables without argv get the column added.
+    """
+    cols = _table_columns(c)
+    if cols.get('cmd') == 'TEXT' and 'argv' in cols:
+        return
+
+    _begin(c)
+    try:
+        # Check again now that we hold the write lock, another process may have migrated in the meantime.
+        cols = _table_columns(c)
+        if cols.get('cmd') != 'TEXT':
+            print("Migrating job database to the current schema.")
+            copied = [('cmd', "COALESCE(cmd, '')"), ('status', "COALESCE(status, '{}')".format(QUEUED)),
+                      ('tries', "COALESCE(tries, 0)"), ('host', "COALESCE(host, '')"),
+                      ('time', "COALESCE(time, '')")]
+            copied = [(col, expr if col in cols else "''") for col, expr in copied]
+
+            c.execute(JOBS_SCHEMA.format(table='jobs_new'))
+            c.execute("INSERT INTO jobs_new (job_id, {}) SELECT job_id, {} FROM jobs".format(
+                ", ".join(col for col, _ in copied), ", ".join(expr for _, expr in copied)))
+            c.execute("DROP TABLE jobs")
+            c.execute("ALTER TABLE jobs_new RENAME TO jobs")
+        elif 'argv' not in cols:
+            c.execute("ALTER TABLE jobs ADD COLUMN argv TEXT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+    c.execute("COMMIT")
+
+
+def _begin(cursor):
+    cursor.execute('BEGIN IMMEDIATE')
+
+
+def _commit(conn):
     conn.commit()
-    cursor.close()
-    conn.close()
 
 
 def _print_not_implemented():
     print("Sorry, not implemented yet :-( Contributions are welcome!")
 
 
-def _check_for_queued_jobs(db_name):
-    conn, c = _get_or_create_db(db_name)
-    c.execute("SELECT * FROM jobs WHERE status=?", (QUEUED,))
-    rows = c.fetchall()
-    _commit_and_close(conn, c)
-    return len(rows)
+def _check_for_queued_jobs(db_name, wal=False):
+    _, c = _get_or_create_db(db_name, wal)
+    c.execute("SELECT COUNT(*) FROM jobs WHERE status=?", (QUEUED,))
+    num_queued = c.fetchone()[0]
+    return num_queued
 
 
 def _host():
-    return socket.gethostname()
-
-
-def _update_str(sets, where='job_id'):
-    if not type(sets) == list:
-        sets = [sets]
-    time_str = _time_str()
-    sets_str = "=?, ".join(sets)
-    sets_str += "=?, time='{}'".format(time_str)
-
-    return "UPDATE jobs SET {} WHERE {}=?".format(sets_str, where)
+    return _HOST
+
+
+def _spawn(argv, gpu_id=''):
+    # The GPU is set for the job only, so that parallel workers can each use their own.
+    child_env = os.environ.copy()
+    if gpu_id:
+        child_env['CUDA_VISIBLE_DEVICES'] = gpu_id
+    return subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=child_env)
+
+
+def _stream_output(proc, chunk_size=65536):
+    # Read stdout and stderr in large chunks until both pipes are closed, printing complete lines. '\r' counts as a
+    # line break so progress bars show up while the job runs, and a partial line longer than chunk_size is printed
+    # as is, which keeps the pending buffer (and the cost of appending to it) bounded.
+    pending = {proc.stdout.fileno(): b'', proc.stderr.fileno(): b''}
+    while pending:
+        readable, _, _ = select.select(list(pending), [], [])
+        for fd in readable:
+            chunk = os.read(fd, chunk_size)
+            if not chunk:
+                lines = [pending.pop(fd)]
+            else:
+                lines = (pending[fd] + chunk.replace(b'\r', b'\n')).split(b'\n')
+                pending[fd] = lines.pop()
+                if len(pending[fd]) > chunk_size:
+                    lines.append(pending[fd])
+                    pending[fd] = b''
+            for line in lines:
+                if line:
+                    print('NL>> ' + line.decode('utf-8', 'replace').strip())
 
 
 def _pull_and_process(args, gpu_id=''):
@@ -93,64 +237,70 @@ def _pull_and_process(args, gpu_id=''):
     print("Add random delay of %d seconds to prevent job overlaps." % delay)
     time.sleep(delay)
 
-    conn, c = _get_or_create_db(args.db_name)
-    c.execute('SELECT * FROM jobs WHERE status=?', (QUEUED,))
-    try:
-        (id, cmd, stat, tries, _, _) = c.fetchone()
-        _commit_and_close(conn, c)
-    except Exception as e:
-        print("Couldn't pull any new jobs." + e.message)
-        _commit_and_close(conn, c)
-        return
-
-    if tries >= args.max_failures:
-        print("This job has failed.")
-        conn, c = _get_or_create_db(args.db_name)
-        update_str = _update_str('status')
-        c.execute(update_str, (FAILED, id))
-        _commit_and_close(conn, c)
+    conn, c = _get_or_create_db(args.db_name, args.wal)
+    # Give up on queued jobs that used up their tries, then claim the next queued job, in one transaction so that
+    # concurrent workers never pick the same row. host keeps the last PID until the job actually runs again.
+    _begin(c)
+    c.execute(FAIL_EXHAUSTED_JOBS, (FAILED, _time_str(), QUEUED, args.max_failures))
+    num_failed = c.rowcount
+    c.execute(CLAIM_NEXT_JOB, (PROCESSING, _time_str(), QUEUED))
+    row = c.fetchone()
+    _commit(conn)
+    if num_failed > 0:
+        print("{} job(s) failed {} times and won't be retried.".format(num_failed, args.max_failures))
+    if row is None:
+        print("Couldn't pull any new jobs.")
         return
-
-    print("Try {}/{} of job #{}: {}".format(tries + 1, args.max_failures, id, cmd))
+    (id, cmd, tries, argv) = row
 
     rc = 1
     try:
-        proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        print("Try {}/{} of job #{}: {}".format(tries, args.max_failures, id, cmd))
+
+        # Jobs added by older versions have no pre-split argv.
+        proc = _spawn(json.loads(argv) if argv is not None else _split_cmd(cmd), gpu_id)
 
         host = "{}:{}:{}".format(_host(), gpu_id, proc.pid)
-        conn, c = _get_or_create_db(args.db_name)
-        c.execute('SELECT * FROM jobs WHERE status=?', (QUEUED,))
-        update_str = _update_str(['status', 'tries', 'host'])
-        c.execute(update_str, (PROCESSING, tries + 1, host, id))
-        _commit_and_close(conn, c)
+        c.execute(UPDATE_HOST, (host, _time_str(), id))
 
-        while True:
-            output = proc.stdout.readline()
-            if output == '' and proc.poll() is not None:
-                break
-            if output:
-                print('NL>> ' + output.strip())
-        rc = proc.poll()
+        _stream_output(proc)
+        rc = proc.wait()
 
         if rc == 0:
-            conn, c = _get_or_create_db(args.db_name)
-            update_str = _update_str(['status'])
-            c.execute(update_str, (DONE, id))
-            _commit_and_close(conn, c)
+            c.execute(UPDATE_STATUS, (DONE, _time_str(), id))
             print('Job done. Process ended with return code', rc)
             return
-    except OSError as e:
-        print(e)
+    except Exception as e:
+        # Whatever went wrong, e.g. a command that can't be parsed or started, the worker carries on.
+        print("Couldn't run job #{}: {}".format(id, e))
 
     print('Job failed. Process ended with return code', rc)
-    conn, c = _get_or_create_db(args.db_name)
-    update_str = _update_str('status')
-    c.execute(update_str, (QUEUED, id))
-    _commit_and_close(conn, c)
+    c.execute(UPDATE_STATUS, (QUEUED, _time_str(), id))
+
+
+def _print_stats(stats):
+    for s in ALL:
+        print("{:<3} {}".format(stats[s], s))
+
+
+def _print_status_summary(c):
+    print()
+    _print_stats(_query_summary(c)[0])
+    print()
+
+
+def _print_change_status(args):
+    if args.verbose:
+        status(args)
+    elif not os.path.exists(args.db_name):
+        print("No job queue. Start by adding jobs.")
+    else:
+        _, c = _get_or_create_db(args.db_name, args.wal)
+        _print_status_summary(c)
 
 
 def _change_status(args, mode):
-    status(args)
+    _print_change_status(args)
 
     selector = []
     if args.all:
@@ -168,28 +318,64 @@ def _change_status(args, mode):
     else:
         selector += ALL
 
-    selector = "('" + "','".join(selector) + "')"
+    selector_str = "('" + "','".join(selector) + "')"
 
     if _get_user_confirmation(
-            "Are you sure that you want to set the status of all {} jobs to {}?".format(selector, mode)):
-        conn, c = _get_or_create_db(args.db_name)
-        sql_cmd = "UPDATE jobs SET status='{}', tries={}, time='{}' WHERE status IN {}".format(mode, 0, _time_str(),
-                                                                                               selector)
-        c.execute(sql_cmd)
-        _commit_and_close(conn, c)
-        print("All {} jobs set to {}.".format(selector, mode))
+            "Are you sure that you want to set the status of all {} jobs to {}?".format(selector_str, mode)):
+        conn, c = _get_or_create_db(args.db_name, args.wal)
+        _begin(c)
+        # One indexed UPDATE per status rather than a single IN (...) scan.
+        time_str = _time_str()
+        c.executemany(RESET_STATUS, [(mode, time_str, s) for s in selector])
+        _commit(conn)
+        print("All {} jobs set to {}.".format(selector_str, mode))
 
-    status(args)
+    _print_change_status(args)
 
 
-def _query_gpu():
+def _watch_db(db_name):
+    """
+    Returns an inotify watch on the directory of the database, or None if inotify_simple is not available.
+    The directory is watched because in WAL mode writes land in the -wal file next to the database.
+    The caller has to close the watch.
+    """
+    if inotify_simple is None:
+        return None
+    watcher = inotify_simple.INotify()
+    flags = inotify_simple.flags
+    watcher.add_watch(os.path.dirname(os.path.abspath(db_name)), flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE)
+    return watcher
+
+
+def _wait_for_db_change(watcher, db_name, timeout_s):
+    # Never wait longer than the polling interval: inotify misses writes from other machines sharing the database
+    # (see README) and writes through bind mounts, so the caller has to re-count the queued jobs regularly anyway.
+    timeout_s = max(0, min(timeout_s, IDLE_CHECK_INTERVAL_MIN * 60))
+    if watcher is None:
+        time.sleep(timeout_s)
+        return
+
+    db_file = os.path.basename(db_name)
+    deadline = time.time() + timeout_s
+    while True:
+        remaining_ms = int((deadline - time.time()) * 1000)
+        if remaining_ms <= 0:
+            return
+        if any(e.name.startswith(db_file) for e in watcher.read(timeout=remaining_ms)):
+            return
+
+
+def _query_gpu(num_workers=1):
     cmd_smi = 'nvidia-smi'
     subprocess.call(cmd_smi.split())
 
-    gpu_id = _get_user_input("\nWhich GPU should be used? [0]", '0')  # , [str(x) for x in range(10)])
+    if num_workers > 1:
+        default = ','.join(str(x) for x in range(num_workers))
+        gpu_id = _get_user_input("\nWhich GPUs should be used, one per worker? [{}]".format(default), default)
+    else:
+        gpu_id = _get_user_input("\nWhich GPU should be used? [0]", '0')  # , [str(x) for x in range(10)])
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = gpu_id
-    print('Set CUDA_VISIBLE_DEVICES to', str(os.environ['CUDA_VISIBLE_DEVICES']))
+    print('Jobs will run with CUDA_VISIBLE_DEVICES set to', gpu_id)
 
     return gpu_id
 
@@ -215,46 +401,70 @@ def _get_user_confirmation(query="Are you sure?"):
     return confirm.lower() == 'yes'
 
 
-def _print_table(cols, rows, print_status=True):
+def _summarize_rows(rows):
+    stats = dict((s, 0) for s in ALL)
+    max_len_cmd = 0
+    max_len_host = 0
+    for row in rows:
+        stats[row[2]] = stats.get(row[2], 0) + 1
+        max_len_cmd = max(max_len_cmd, len(row[1]))
+        max_len_host = max(max_len_host, len(row[4] or ''))
+    return stats, max_len_cmd, max_len_host
+
+
+def _query_summary(c):
+    c.execute('SELECT status, COUNT(*), MAX(LENGTH(cmd)), MAX(LENGTH(host)) FROM jobs GROUP BY status')
+
+    stats = dict((s, 0) for s in ALL)
+    max_len_cmd = 0
+    max_len_host = 0
+    for (stat, count, len_cmd, len_host) in c.fetchall():
+        stats[stat] = count
+        max_len_cmd = max(max_len_cmd, len_cmd or 0)
+        max_len_host = max(max_len_host, len_host or 0)
+    return stats, max_len_cmd, max_len_host
+
+
+def _iter_rows(cursor, batch_size=1000):
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        for row in batch:
+            yield row
+
+
+def _print_table(rows, print_status=True, summary=None):
+    """
+    Prints rows as a table. If a summary from _query_summary is given, rows may be any iterable and is only
+    consumed once, otherwise it must be a list.
+    """
     max_len_jobname = 91
 
-    if len(rows) == 0:
+    if summary is None:
+        summary = _summarize_rows(rows)
+    stats, max_len_cmd, max_len_host = summary
+
+    if sum(stats.values()) == 0:
         return
 
-    if print_status:
-        stats = dict()
-        for s in ALL:
-            stats[s] = sum(1 for x in rows if x[2] == s)
-
-    len_cmd = min(max(len(x[1]) for x in rows) + 5, max_len_jobname + 6)
-    # TODO(haeusser) remove fallback
-    if len(cols) == 6:
-        len_host = min(max([4] + [len(x[4]) for x in rows]), max_len_jobname + 6) + 2
-    else:
-        len_host = 5
-    str_template = "{:<5}{:<" + str(len_cmd) + "}{:<13}{:<7}{:<" + str(len_host) + "}{:<11}"
+    len_cmd = min(max_len_cmd + 5, max_len_jobname + 6)
+    len_host = min(max(4, max_len_host), max_len_jobname + 6) + 2
+    widths = dict(len_cmd=len_cmd, len_host=len_host)
 
     print()
-    header = str_template.format("ID", "COMMAND", "STATUS", "TRIES", "HOST:GPU:PID", "CHANGED")
+    header = TABLE_TEMPLATE.format("ID", "COMMAND", "STATUS", "TRIES", "HOST:GPU:PID", "CHANGED", **widths)
     print(header)
     print("-" * len(header))
 
-    for row in rows:
-        # TODO(haeusser) remove fallback
-        if len(cols) == 6:
-            (id, cmd, stat, tries, host, changed) = row
-        else:
-            (id, cmd, stat, tries) = row
-            host = 'N/A'
-            changed = 'N/A'
+    for (id, cmd, stat, tries, host, changed) in rows:
         host = host or ''
         cmd = ('...' + cmd[-max_len_jobname:]) if len(cmd) > max_len_jobname else cmd
-        print(str_template.format(id, cmd, stat, tries, host, changed))
+        print(TABLE_TEMPLATE.format(id, cmd, stat, tries, host, changed, **widths))
     print("-" * len(header))
 
     if print_status:
-        for s in ALL:
-            print("{:<3} {}".format(stats[s], s))
+        _print_stats(stats)
     print()
 
 
@@ -267,16 +477,22 @@ def add(args):
     :return: Nothing
     """
     job = args.job
+    jobs = _parse_jobs([job])
+    if len(jobs) == 0:
+        return
+
     print('Adding', job)
-    conn, c = _get_or_create_db(args.db_name)
+    conn, c = _get_or_create_db(args.db_name, args.wal)
     status = HOLD if args.hold else QUEUED
-    _add_single_job(c, job, status)
-    _commit_and_close(conn, c)
+    _begin(c)
+    _add_single_job(c, job, jobs[0][1], status)
+    _commit(conn)
 
 
 def add_list(args):
     """
-    Adds a number of jobs from an external text file. The file must contain one command per line.
+    Adds a number of jobs from an external text file. The file must contain one command per line,
+    blank lines are skipped and invalid commands are reported and skipped.
     :param args: An argparse object containing the following properties:
             joblist: A string containing a valid path to a text file.
             db_name: A string containing a filename for the database.
@@ -288,19 +504,19 @@ def add_list(args):
     assert os.path.exists(joblist), "Joblist file not found: " + joblist
 
     with open(joblist) as f:
-        lines = f.readlines()
+        lines = [line.rstrip('\n') for line in f if line.strip()]
 
     assert len(lines) > 0, "No commands found."
 
+    jobs = _parse_jobs(lines)
     status = HOLD if args.hold else QUEUED
 
-    conn, c = _get_or_create_db(args.db_name)
-    for job in lines:
-        job = job.rstrip('\n')
-        _add_single_job(c, job, status)
-    _commit_and_close(conn, c)
+    conn, c = _get_or_create_db(args.db_name, args.wal)
+    _begin(c)
+    _add_jobs(c, jobs, status)
+    _commit(conn)
 
-    print("Added", len(lines), "jobs.")
+    print("Added", len(jobs), "jobs.")
 
 
 def status(args):
@@ -315,16 +531,12 @@ def status(args):
         print("No job queue. Start by adding jobs.")
         return
 
-    conn, c = _get_or_create_db(args.db_name)
-
-    c.execute('SELECT * FROM jobs ORDER BY status')
-    rows = c.fetchall()
+    _, c = _get_or_create_db(args.db_name, args.wal)
 
-    c.execute("PRAGMA table_info(jobs)")
-    cols = c.fetchall()
-    _commit_and_close(conn, c)
+    summary = _query_summary(c)
 
-    _print_table(cols, rows)
+    c.execute('SELECT {} FROM jobs ORDER BY status'.format(TABLE_COLUMNS))
+    _print_table(_iter_rows(c), summary=summary)
 
 
 def start(args):
@@ -333,13 +545,29 @@ def start(args):
     :param args: An argparse object containing the following properties:
             db_name: A string containing a filename for the database.
             max_idle_minutes: Number of minutes to idle before quitting the processing loop.
+            workers: Number of jobs to process in parallel.
     :return: Nothing.
     """
     assert os.path.exists(args.db_name), "No joblist found in {}. Please start with adding jobs.".format(args.db_name)
 
-    gpu_id = _query_gpu()
+    gpu_id = _query_gpu(args.workers)
+    watcher = _watch_db(args.db_name)
+
+    try:
+        if args.workers > 1:
+            _start_workers(args, gpu_id.split(','), watcher)
+        else:
+            _start_serial(args, gpu_id, watcher)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
 
-    num_queued = _check_for_queued_jobs(args.db_name)
+def _start_serial(args, gpu_id, watcher):
+    """
+    The processing loop of start for a single worker: processes one job after the other in this process.
+    """
+    num_queued = _check_for_queued_jobs(args.db_name, args.wal)
     begin_idle_time = datetime.datetime.now()
     end_idle_time = begin_idle_time + datetime.timedelta(seconds=args.max_idle_minutes * 60)
 
@@ -352,8 +580,50 @@ def start(args):
             str_end_time = end_idle_time.strftime("%H:%M")
             str_delta = str(end_idle_time - datetime.datetime.now())[:-7]
             print("No jobs queued. Waiting for new ones until {} ({} left).".format(str_end_time, str_delta))
-            time.sleep(IDLE_CHECK_INTERVAL_MIN * 60)
-        num_queued = _check_for_queued_jobs(args.db_name)
+            _wait_for_db_change(watcher, args.db_name, (end_idle_time - datetime.datetime.now()).total_seconds())
+        num_queued = _check_for_queued_jobs(args.db_name, args.wal)
+
+
+def _start_workers(args, gpu_ids, watcher):
+    """
+    Like the processing loop in start, but keeps up to args.workers jobs running in parallel, each in its own
+    worker process. Worker i runs its jobs with gpu_id gpu_ids[i % len(gpu_ids)].
+    """
+    idle_delta = datetime.timedelta(seconds=args.max_idle_minutes * 60)
+    end_idle_time = datetime.datetime.now() + idle_delta
+    running = {}  # future -> worker slot
+
+    # Spawned, not forked: the children must not share this process' sqlite connection.
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=mp_context) as executor:
+        while True:
+            num_queued = _check_for_queued_jobs(args.db_name, args.wal)
+            for slot in range(args.workers):
+                if num_queued == 0:
+                    break
+                if slot not in running.values():
+                    future = executor.submit(_pull_and_process, args, gpu_ids[slot % len(gpu_ids)])
+                    running[future] = slot
+                    num_queued -= 1
+
+            if running:
+                done, _ = concurrent.futures.wait(running, timeout=IDLE_CHECK_INTERVAL_MIN * 60,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # One broken job or a locked database must not stop the other workers.
+                        print("Worker failed: {}".format(e))
+                end_idle_time = datetime.datetime.now() + idle_delta
+            elif datetime.datetime.now() >= end_idle_time:
+                break
+            else:
+                str_end_time = end_idle_time.strftime("%H:%M")
+                str_delta = str(end_idle_time - datetime.datetime.now())[:-7]
+                print("No jobs queued. Waiting for new ones until {} ({} left).".format(str_end_time, str_delta))
+                _wait_for_db_change(watcher, args.db_name, (end_idle_time - datetime.datetime.now()).total_seconds())
 
 
 def queue(args):
@@ -402,29 +672,25 @@ def remove(args):
 
     selector = "('" + "','".join(ids_to_remove) + "')"
 
-    conn, c = _get_or_create_db(args.db_name)
+    _, c = _get_or_create_db(args.db_name, args.wal)
 
-    c.execute('SELECT * FROM jobs WHERE {} IN {}'.format(select_by, selector))
+    c.execute('SELECT {} FROM jobs WHERE {} IN {}'.format(TABLE_COLUMNS, select_by, selector))
     rows = c.fetchall()
 
     if len(rows) == 0:
         print("No jobs matched your criteria.")
         return
 
-    c.execute("PRAGMA table_info(jobs)")
-    cols = c.fetchall()
-
     print("I will remove the following jobs. Currently running jobs will NOT be killed.")
-    _commit_and_close(conn, c)
 
-    _print_table(cols, rows, print_status=False)
+    _print_table(rows, print_status=False)
 
     if _get_user_confirmation():
-        conn, c = _get_or_create_db(args.db_name)
-
+        conn, c = _get_or_create_db(args.db_name, args.wal)
+        _begin(c)
         c.execute('DELETE FROM jobs WHERE {} IN {}'.format(select_by, selector))
 
-        _commit_and_close(conn, c)
+        _commit(conn)
 
     status(args)
 
@@ -434,6 +700,11 @@ if __name__ == '__main__':
     options_parser.add_argument("--db_name",
                                 help="Choose a specific name for the job database. Default: joblist.sqlite3",
                                 default="joblist.sqlite3")
+    options_parser.add_argument("--wal",
+                                help="Switch the job database to SQLite's faster WAL mode. The setting is stored in "
+                                     "the database. Only use it if the database is on a local filesystem and "
+                                     "everything using it runs on that machine.",
+                                action='store_true')
 
     parser = argparse.ArgumentParser(prog="NebuLight")
     subparsers = parser.add_subparsers(title="Actions")
@@ -457,7 +728,9 @@ if __name__ == '__main__':
     sp.add_argument('--max_idle_minutes', help='Maximum number of minutes to wait for new jobs before quitting.',
                     default=180, type=int)
     sp.add_argument("--gpu", help="Set CUDA_VISIBLE_DEVICES environment variable before execution.")
-    sp.add_argument("--max_failures", help="Maximum number of failures for job before it is abandoned.", default=3)
+    sp.add_argument("--max_failures", help="Maximum number of failures for job before it is abandoned.", default=3,
+                    type=int)
+    sp.add_argument("--workers", help="Number of jobs to process in parallel, e.g. one per GPU.", default=1, type=int)
     sp.set_defaults(func=start)
 
     sp = subparsers.add_parser("queue", help="Set all jobs to 'queued'.", parents=[options_parser])
@@ -466,6 +739,7 @@ if __name__ == '__main__':
     sp.add_argument("--failed", help="Re-enqueue all failed jobs to status 'queued'.", action='store_true')
     sp.add_argument("--hold", help="Re-enqueue all held jobs to status 'queued'.", action='store_true')
     sp.add_argument("--processing", help="Re-enqueue all processing jobs to status 'queued'.", action='store_true')
+    sp.add_argument("--verbose", help="Print the full job table before and after the change.", action='store_true')
     sp.set_defaults(func=queue)
 
     sp = subparsers.add_parser("hold", help="Set all jobs to 'hold'.", parents=[options_parser])
@@ -475,6 +749,7 @@ if __name__ == '__main__':
     sp.add_argument("--hold", help="Set all held jobs to status 'hold'.", action='store_true')
     sp.add_argument("--processing", help="Set all processing jobs to status 'hold'.", action='store_true')
     sp.add_argument("--queued", help="Set all queued jobs to status 'hold'.", action='store_true')
+    sp.add_argument("--verbose", help="Print the full job table before and after the change.", action='store_true')
     sp.set_defaults(func=hold)
 
     sp = subparsers.add_parser("remove", help="Remove jobs by their ID..", parents=[options_parser])